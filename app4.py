@@ -10,17 +10,55 @@ import pandas as pd
 import smtplib
 import sqlite3
 import json
+import zlib
+import sys
+import random
+import cProfile
+import pstats
+import contextlib
+import altair as alt
 import streamlit as st
 import re
+import time
+import tempfile
+import logging
+import threading
+import mmap
+import struct
+import atexit
+import hashlib
+import uuid
+import concurrent.futures
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from datetime import datetime
 from dotenv import load_dotenv
-from agents import Agent, Runner, function_tool, handoff, RunContextWrapper
+from jinja2 import DictLoader, Environment, select_autoescape
+from lead_export import EXPORT_FORMATS, available_export_formats, export_leads
+from agents import Agent, Runner, ModelSettings, function_tool, handoff, RunContextWrapper
+from agents import Model, ModelProvider, RunConfig, AgentsException
+from agents.models.multi_provider import MultiProvider
+try:
+    import zstandard
+except ImportError:  # optional: transcripts fall back to zlib
+    zstandard = None
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from streamlit.runtime.scriptrunner_utils.script_run_context import SCRIPT_RUN_CONTEXT_ATTR_NAME
+try:
+    from streamlit.web.server.app_static_file_handler import MAX_APP_STATIC_FILE_SIZE
+except ImportError:
+    MAX_APP_STATIC_FILE_SIZE = 200 * 1024 * 1024  # Streamlit answers 404 for larger static files
 vector_store_id = os.environ.get("vector_store_id")
 
 # Local product database configuration
 PRODUCTS_FILE = "toanchan/toanchan_products.jsonl"
+PRODUCTS_CATALOG_FILE = os.getenv("PRODUCTS_CATALOG_FILE", "toanchan/toanchan_products.catalog")  # Compiled from PRODUCTS_FILE on demand
 PRODUCTS_IMAGE_DIR = "toanchan"
 ORDERS_FILE = "toanchan/mock_orders.json"
 # ============================================================================
@@ -43,6 +81,13 @@ EMAIL_ENABLED = EMAIL_USER and EMAIL_APP_PASSWORD
 
 # Database Configuration
 DB_FILE = os.getenv("DB_FILE", "week3-db_leads.db")
+LEADS_FTS_ENABLED = True  # Switched off by init_database when SQLite lacks FTS5
+# Exports are written here and served by Streamlit's static file handler (see .streamlit/config.toml)
+EXPORT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "exports")
+EXPORT_MAX_AGE = int(os.getenv("EXPORT_MAX_AGE", "3600"))  # seconds an export stays downloadable
+EXPORT_CLEANUP_INTERVAL = 300  # seconds between sweeps for expired exports
+LIVE_TRANSCRIPT_MESSAGES = int(os.getenv("LIVE_TRANSCRIPT_MESSAGES", "40"))  # older turns stay in the archive only
+ARCHIVE_PAGE_MESSAGES = int(os.getenv("ARCHIVE_PAGE_MESSAGES", "20"))  # archived messages loaded per "load earlier" click
 
 # Email routing configuration (update these with real addresses in production)
 EMAIL_ROUTING = {
@@ -51,43 +96,74 @@ EMAIL_ROUTING = {
     "orderlookup": EMAIL_USER # Replace with actual support email
 }
 
+# Digest mode: leads for the same destination arriving within the window are sent as one email.
+# Windows are in seconds per EMAIL_ROUTING key; 0 sends every lead immediately.
+EMAIL_DIGEST_WINDOW = int(os.getenv("EMAIL_DIGEST_WINDOW", "0"))
+EMAIL_DIGEST_WINDOWS = {
+    "wholesale": EMAIL_DIGEST_WINDOW,
+    "Product recommendations": EMAIL_DIGEST_WINDOW,
+    "orderlookup": EMAIL_DIGEST_WINDOW
+}
+EMAIL_IMMEDIATE_PRIORITIES = {"high", "urgent"}  # always sent right away, even in digest mode
+EMAIL_DIGEST_RETRY_DELAY = int(os.getenv("EMAIL_DIGEST_RETRY_DELAY", "60"))  # seconds before resending a failed digest
+
 # Cache for lead deduplication
 LEAD_INFO_CACHE = {}
 LEAD_EMAIL_CACHE = {}
 EMAIL_DEDUPE_WINDOW = 300  # seconds
 
+# Compiled product catalog format
+CATALOG_MAGIC = b"TCCATLG\0"
+CATALOG_VERSION = 1
+CATALOG_HEADER = struct.Struct("<8sIIII")
+CATALOG_STRING_COLUMNS = ("name", "text", "text_lower", "image")
+
+# Blocking tool I/O (SQLite, files, SMTP) runs on a bounded thread pool shared by all sessions
+ASYNC_TOOLS_ENABLED = os.getenv("ASYNC_TOOLS", "1") != "0"
+TOOL_EXECUTOR_WORKERS = int(os.getenv("TOOL_EXECUTOR_WORKERS", "8"))
+
+# Model call governor: one budget for every session in this process
+MODEL_MAX_CONCURRENCY = int(os.getenv("MODEL_MAX_CONCURRENCY", "8"))
+MODEL_REQUESTS_PER_MINUTE = int(os.getenv("MODEL_REQUESTS_PER_MINUTE", "300"))
+MODEL_TOKENS_PER_MINUTE = int(os.getenv("MODEL_TOKENS_PER_MINUTE", "150000"))
+MODEL_OUTPUT_TOKEN_ESTIMATE = 500  # reserved per call on top of the estimated prompt size
+MODEL_RETRY_ATTEMPTS = int(os.getenv("MODEL_RETRY_ATTEMPTS", "5"))
+RETRYABLE_MODEL_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+# Usage accounting: USD per 1M tokens as (input, cached input, output)
+USAGE_DEFAULT_MODEL = os.getenv("OPENAI_DEFAULT_MODEL", "gpt-4o")
+MODEL_PRICING = {
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4.1": (2.00, 0.50, 8.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+}
+
+# Opt-in request profiling: PROFILE_REQUESTS=1 profiles every request, PROFILE_SAMPLE_RATE=N one in N
+PROFILE_REQUESTS = os.getenv("PROFILE_REQUESTS", "0") == "1"
+PROFILE_SAMPLE_RATE = int(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_SAMPLE_INTERVAL = 0.005  # seconds between stack samples
+PROFILE_TOP_FUNCTIONS = 30
+PROFILE_RETENTION = int(os.getenv("PROFILE_RETENTION", "200"))  # newest profiles kept; older ones are deleted
+
+logger = logging.getLogger(__name__)
+
 # ============================================================================
 # LOCAL PRODUCT DATABASE FUNCTIONS
 # ============================================================================
 
-def load_orders_database():
-    """Load orders from local JSON file."""
-    orders = []
-    try:
-        if os.path.exists(ORDERS_FILE):
-            with open(ORDERS_FILE, 'r', encoding='utf-8') as f:
-                orders = json.load(f)
-            log_system_message(f"ORDERS: Loaded {len(orders)} orders from database")
-        else:
-            log_system_message(f"ORDERS: File {ORDERS_FILE} not found")
-    except Exception as e:
-        log_system_message(f"ORDERS ERROR: Failed to load orders: {str(e)}")
-    return orders
-
 def search_order_by_id(order_id):
     """Search for an order by order ID."""
-    orders = load_orders_database()
-    if not orders:
-        return None
-    
-    for order in orders:
-        if order.get('order_id', '').lower() == order_id.lower():
-            return order
-    return None
+    return get_data_sources().orders.by_id.get(order_id.lower())
 
 def search_orders_by_customer(customer_info):
     """Search for orders by customer name or phone."""
-    orders = load_orders_database()
+    orders = get_data_sources().orders.orders
     if not orders:
         return []
     
@@ -105,9 +181,8 @@ def search_orders_by_customer(customer_info):
     
     return matching_orders
 
-@function_tool
-def lookup_order(search_term: str) -> str:
-    """Look up order information by order ID, customer name, or phone number."""
+def find_order_details(search_term):
+    """Look up an order and format the result for the agent."""
     try:
         search_term = search_term.strip()
         
@@ -165,50 +240,235 @@ def lookup_order(search_term: str) -> str:
         log_system_message(f"ORDERS ERROR: {error_msg}")
         return error_msg
 
-def load_products_database():
-    """Load products from local JSONL file."""
+@function_tool
+def lookup_order(search_term: str) -> str:
+    """Look up order information by order ID, customer name, or phone number."""
+    return find_order_details(search_term)
+
+def load_products_database(source_file=PRODUCTS_FILE, strict=False):
+    """Load products from local JSONL file.
+
+    With strict=True any unreadable line raises instead of returning the products parsed so far,
+    so a half-written file can never be mistaken for a shorter catalog.
+    """
     products = []
     try:
-        if os.path.exists(PRODUCTS_FILE):
-            with open(PRODUCTS_FILE, 'r', encoding='utf-8') as f:
-                for line in f:
+        if os.path.exists(source_file):
+            with open(source_file, 'r', encoding='utf-8') as f:
+                for line_number, line in enumerate(f, 1):
                     if line.strip():
-                        product = json.loads(line.strip())
+                        try:
+                            product = json.loads(line.strip())
+                        except ValueError as e:
+                            raise ValueError(f"{source_file} line {line_number}: {e}") from e
                         products.append(product)
             log_system_message(f"PRODUCTS: Loaded {len(products)} products from local database")
         else:
-            log_system_message(f"PRODUCTS: File {PRODUCTS_FILE} not found")
+            log_system_message(f"PRODUCTS: File {source_file} not found")
     except Exception as e:
         log_system_message(f"PRODUCTS ERROR: Failed to load products: {str(e)}")
+        if strict:
+            raise
     return products
 
+def parse_price_cents(price):
+    """Convert a catalog price such as "$20" or "$19.50" to integer cents (-1 if missing)."""
+    match = re.search(r"\d+(?:\.\d{1,2})?", str(price or "").replace(",", ""))
+    if not match:
+        return -1
+    return int(round(float(match.group()) * 100))
+
+def format_price_cents(cents):
+    """Format integer cents back into the catalog's "$20" display style."""
+    if cents < 0:
+        return "Price not available"
+    dollars, rem = divmod(cents, 100)
+    return f"${dollars}" if rem == 0 else f"${dollars}.{rem:02d}"
+
+def build_product_catalog(source_file=PRODUCTS_FILE, catalog_file=PRODUCTS_CATALOG_FILE):
+    """Compile the JSONL product file into the binary catalog format.
+
+    Layout (little endian, every section 4-byte aligned):
+        header   magic, version, product count, string count, string blob size
+        strings  uint32 offsets[string count + 1] followed by the UTF-8 blob
+        columns  uint32 name[n], text[n], text_lower[n], image[n]; int32 price_cents[n]
+    Each distinct string is stored once and columns refer to it by index.
+    """
+    products = load_products_database(source_file, strict=True)
+
+    strings, string_ids = [], {}
+    def intern(value):
+        value = value or ""
+        if value not in string_ids:
+            string_ids[value] = len(strings)
+            strings.append(value)
+        return string_ids[value]
+
+    columns = {name: array("I") for name in CATALOG_STRING_COLUMNS}
+    prices = array("i")
+    for product in products:
+        metadata = product.get('metadata', {})
+        text = product.get('text', '')
+        columns["name"].append(intern(metadata.get('product_name', '')))
+        columns["text"].append(intern(text))
+        columns["text_lower"].append(intern(text.lower()))
+        columns["image"].append(intern(metadata.get('image_path', '')))
+        prices.append(parse_price_cents(product.get('price')))
+
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = array("I", [0])
+    for data in encoded:
+        offsets.append(offsets[-1] + len(data))
+    blob = b"".join(encoded)
+    blob += b"\0" * (-len(blob) % 4)
+
+    # Write next to the target and swap in, so readers never map a partial file
+    tmp_file = f"{catalog_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'wb') as f:
+        f.write(CATALOG_HEADER.pack(CATALOG_MAGIC, CATALOG_VERSION, len(products), len(strings), len(blob)))
+        f.write(offsets.tobytes())
+        f.write(blob)
+        for name in CATALOG_STRING_COLUMNS:
+            f.write(columns[name].tobytes())
+        f.write(prices.tobytes())
+    os.replace(tmp_file, catalog_file)
+    log_system_message(f"PRODUCTS: Compiled {len(products)} products ({len(strings)} unique strings) into {catalog_file}")
+
+class ProductRecord:
+    """Lightweight view of one product row in a memory-mapped catalog."""
+    __slots__ = ("_catalog", "_index")
+
+    def __init__(self, catalog, index):
+        self._catalog = catalog
+        self._index = index
+
+    @property
+    def name(self):
+        return self._catalog.string(self._catalog.columns["name"][self._index])
+
+    @property
+    def text(self):
+        return self._catalog.string(self._catalog.columns["text"][self._index])
+
+    @property
+    def text_lower(self):
+        return self._catalog.string(self._catalog.columns["text_lower"][self._index])
+
+    @property
+    def image_path(self):
+        return self._catalog.string(self._catalog.columns["image"][self._index])
+
+    @property
+    def price_cents(self):
+        return self._catalog.prices[self._index]
+
+    @property
+    def price(self):
+        return format_price_cents(self.price_cents)
+
+    def __repr__(self):
+        return f"ProductRecord({self.name!r}, {self.price})"
+
+class ProductCatalog:
+    """Read-only, memory-mapped product catalog shared between processes through the page cache."""
+
+    def __init__(self, catalog_file):
+        self.path = catalog_file
+        with open(catalog_file, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.mtime = os.path.getmtime(catalog_file)
+
+        magic, version, count, string_count, blob_size = CATALOG_HEADER.unpack_from(self._mmap, 0)
+        if magic != CATALOG_MAGIC or version != CATALOG_VERSION:
+            raise ValueError(f"{catalog_file} is not a version {CATALOG_VERSION} product catalog")
+
+        view = memoryview(self._mmap)
+        pos = CATALOG_HEADER.size
+        self._offsets = view[pos:pos + 4 * (string_count + 1)].cast("I")
+        pos += 4 * (string_count + 1)
+        self._blob = view[pos:pos + blob_size]
+        pos += blob_size
+        self.columns = {}
+        for name in CATALOG_STRING_COLUMNS:
+            self.columns[name] = view[pos:pos + 4 * count].cast("I")
+            pos += 4 * count
+        self.prices = view[pos:pos + 4 * count].cast("i")
+        self._count = count
+        # Decoded lazily; each distinct string is decoded at most once per process
+        self._strings = [None] * string_count
+
+    def string(self, string_id):
+        value = self._strings[string_id]
+        if value is None:
+            start, end = self._offsets[string_id], self._offsets[string_id + 1]
+            value = self._strings[string_id] = str(self._blob[start:end], 'utf-8')
+        return value
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if not 0 <= index < self._count:
+            raise IndexError(index)
+        return ProductRecord(self, index)
+
+    def __iter__(self):
+        return (ProductRecord(self, i) for i in range(self._count))
+
+def catalog_is_current(catalog_file, source_file):
+    return os.path.exists(catalog_file) and os.path.getmtime(catalog_file) >= os.path.getmtime(source_file)
+
+def writable_catalog_file(catalog_file):
+    """Use the configured catalog path, or the temp directory when its directory is read-only."""
+    directory = os.path.dirname(os.path.abspath(catalog_file))
+    if os.access(directory, os.W_OK):
+        return catalog_file
+    return os.path.join(tempfile.gettempdir(), os.path.basename(catalog_file))
+
+def open_product_catalog(source_file=PRODUCTS_FILE, catalog_file=PRODUCTS_CATALOG_FILE):
+    """Map the compiled catalog, rebuilding it first when the JSONL source is newer.
+
+    A prebuilt catalog at the configured path is used as long as it is current, even when its
+    directory is read-only. If the catalog cannot be written, the products are served from JSONL
+    rows in memory instead.
+    """
+    if os.path.exists(source_file) and not catalog_is_current(catalog_file, source_file):
+        catalog_file = writable_catalog_file(catalog_file)
+        if not catalog_is_current(catalog_file, source_file):
+            try:
+                build_product_catalog(source_file, catalog_file)
+            except OSError as e:
+                log_system_message(f"PRODUCTS: Cannot write {catalog_file} ({e}); serving products from JSONL")
+                return [JsonlProduct(product) for product in load_products_database(source_file, strict=True)]
+    return ProductCatalog(catalog_file)
+
+def load_product_catalog():
+    """Return the current product snapshot (compiled catalog plus any lines appended since)."""
+    return get_data_sources().products
+
 def search_products_by_symptoms(query, max_results=3):
     """Search products based on symptoms/indications."""
-    products = load_products_database()
+    products = load_product_catalog()
     if not products:
         return []
-    
-    query_lower = query.lower()
+
+    query_words = [word for word in query.lower().split() if len(word) > 2]  # Skip very short words
     scored_products = []
-    
+
     for product in products:
-        text = product.get('text', '').lower()
-        product_name = product.get('metadata', {}).get('product_name', '')
-        
+        text = product.text_lower
+
         # Simple scoring based on keyword matches
         score = 0
-        query_words = query_lower.split()
-        
         for word in query_words:
-            if len(word) > 2:  # Skip very short words
-                if word in text:
-                    score += 1
-        
+            if word in text:
+                score += 1
+
         if score > 0:
             scored_products.append({
                 'product': product,
                 'score': score,
-                'name': product_name
+                'name': product.name
             })
     
     # Sort by score and return top results
@@ -228,11 +488,10 @@ def search_herbal_products(symptoms: str, max_results: int = 3) -> str:
         
         for i, result in enumerate(results, 1):
             product = result['product']
-            metadata = product.get('metadata', {})
-            product_name = metadata.get('product_name', 'Unknown Product')
-            description = product.get('text', 'No description available')
-            price = product.get('price', 'Price not available')
-            image_path = metadata.get('image_path', '')
+            product_name = product.name or 'Unknown Product'
+            description = product.text or 'No description available'
+            price = product.price
+            image_path = product.image_path
             
             response += f"**{i}. {product_name}**\n"
             response += f"   - Price: {price}\n"
@@ -252,12 +511,223 @@ def search_herbal_products(symptoms: str, max_results: int = 3) -> str:
         log_system_message(f"PRODUCTS ERROR: {error_msg}")
         return error_msg
 
+# ============================================================================
+# DATA SOURCE WATCHER
+# ============================================================================
+
+class JsonlProduct:
+    """Product parsed straight from JSONL: lines appended since the last compile, or every line
+    when the catalog cannot be compiled."""
+    __slots__ = ("name", "text", "text_lower", "image_path", "price_cents")
+
+    def __init__(self, product):
+        metadata = product.get('metadata', {})
+        self.name = metadata.get('product_name', '')
+        self.text = product.get('text', '')
+        self.text_lower = self.text.lower()
+        self.image_path = metadata.get('image_path', '')
+        self.price_cents = parse_price_cents(product.get('price'))
+
+    @property
+    def price(self):
+        return format_price_cents(self.price_cents)
+
+class ProductSnapshot:
+    """Immutable view of the catalog; appended products replace catalog rows with the same name."""
+    __slots__ = ("catalog", "appended", "_count")
+
+    def __init__(self, catalog, appended=None):
+        self.catalog = catalog
+        self.appended = appended or {}
+        catalog_names = {record.name for record in catalog}
+        self._count = len(catalog) + sum(1 for name in self.appended if name not in catalog_names)
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for record in self.catalog:
+            if record.name not in self.appended:
+                yield record
+        yield from self.appended.values()
+
+class OrderSnapshot:
+    """Immutable view of the orders file with an order ID index."""
+    __slots__ = ("orders", "by_id")
+
+    def __init__(self, orders):
+        self.orders = tuple(orders)
+        self.by_id = {order.get('order_id', '').lower(): order for order in self.orders}
+
+class DataSources:
+    """Holds the current product and order snapshots and refreshes them when the files change.
+
+    Writers build a complete new snapshot and then swap a single attribute, so readers never
+    take a lock and never observe a half-loaded catalog.
+    """
+    DIGEST_CHUNK_BYTES = 1 << 16
+
+    def __init__(self, products_file, orders_file, catalog_file):
+        self.products_file = os.path.abspath(products_file)
+        self.orders_file = os.path.abspath(orders_file)
+        self.catalog_file = catalog_file
+        self._reload_lock = threading.Lock()
+        self._products_offset = 0
+        self._products_prefix_digest = None
+        self._orders_mtime = None
+        self.observer = None
+        self.products = ProductSnapshot([])
+        self.orders = OrderSnapshot([])
+        self.reload_products(full=True)
+        self.reload_orders()
+
+    def _prefix_digest(self, f, offset):
+        """SHA-1 of the first offset bytes, i.e. everything already loaded, so any edit to it is noticed."""
+        digest = hashlib.sha1()
+        f.seek(0)
+        remaining = offset
+        while remaining:
+            chunk = f.read(min(remaining, self.DIGEST_CHUNK_BYTES))
+            if not chunk:
+                break
+            digest.update(chunk)
+            remaining -= len(chunk)
+        return digest.hexdigest()
+
+    def reload_products(self, full=False):
+        """Apply changes to the product file: parse appended lines, or recompile after other edits."""
+        with self._reload_lock:
+            try:
+                if not os.path.exists(self.products_file):
+                    if not self.products.catalog and os.path.exists(self.catalog_file):
+                        self.products = ProductSnapshot(ProductCatalog(self.catalog_file))
+                    return
+                if not full and self._append_products():
+                    return
+
+                size = os.path.getsize(self.products_file)
+                old = {p.name: (p.text, p.price_cents) for p in self.products}
+                snapshot = ProductSnapshot(open_product_catalog(self.products_file, self.catalog_file))
+                with open(self.products_file, 'rb') as f:
+                    self._products_prefix_digest = self._prefix_digest(f, size)
+                self._products_offset = size
+                self.products = snapshot
+
+                new = {p.name: (p.text, p.price_cents) for p in snapshot}
+                changed = sum(1 for name in new if name in old and old[name] != new[name])
+                logger.info(f"PRODUCTS: Reloaded catalog ({len(new.keys() - old.keys())} added, "
+                            f"{changed} changed, {len(old.keys() - new.keys())} removed)")
+            except Exception as e:
+                logger.error(f"PRODUCTS ERROR: Reload failed, keeping previous catalog: {e}")
+
+    def _append_products(self):
+        """Parse only the complete lines added since the last load; False if the file was not just appended to."""
+        with open(self.products_file, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < self._products_offset or self._prefix_digest(f, self._products_offset) != self._products_prefix_digest:
+                return False
+            f.seek(self._products_offset)
+            data = f.read(size - self._products_offset)
+            consumed = data.rfind(b"\n") + 1  # a trailing partial line waits for the next event
+            if not consumed:
+                return True
+
+            appended = dict(self.products.appended)
+            for line in data[:consumed].splitlines():
+                if line.strip():
+                    try:
+                        product = JsonlProduct(json.loads(line))
+                    except ValueError as e:
+                        # Skip it so later appends still apply; a full recompile will report it again
+                        logger.error(f"PRODUCTS ERROR: Skipping malformed appended line: {e}")
+                        continue
+                    appended[product.name] = product
+
+            self._products_offset += consumed
+            self._products_prefix_digest = self._prefix_digest(f, self._products_offset)
+        self.products = ProductSnapshot(self.products.catalog, appended)
+        logger.info(f"PRODUCTS: Applied {consumed} appended bytes ({len(appended)} products now override the catalog)")
+        return True
+
+    def reload_orders(self):
+        """Reload the orders file and swap in a new snapshot, reusing unchanged order records."""
+        with self._reload_lock:
+            try:
+                if not os.path.exists(self.orders_file):
+                    return
+                mtime = os.path.getmtime(self.orders_file)
+                if mtime == self._orders_mtime:
+                    return
+                with open(self.orders_file, 'r', encoding='utf-8') as f:
+                    orders = json.load(f)  # a half-written file fails here and the old snapshot stays
+                previous = self.orders.by_id
+                merged, added, changed = [], 0, 0
+                for order in orders:
+                    key = order.get('order_id', '').lower()
+                    if previous.get(key) == order:
+                        merged.append(previous[key])
+                    else:
+                        merged.append(order)
+                        if key in previous:
+                            changed += 1
+                        else:
+                            added += 1
+                snapshot = OrderSnapshot(merged)
+                removed = len(previous.keys() - snapshot.by_id.keys())
+                self.orders = snapshot
+                self._orders_mtime = mtime
+                logger.info(f"ORDERS: Reloaded {len(merged)} orders ({added} added, {changed} changed, {removed} removed)")
+            except Exception as e:
+                logger.error(f"ORDERS ERROR: Reload failed, keeping previous orders: {e}")
+
+    def start(self):
+        """Watch the data directories with watchdog."""
+        handler = DataSourceEventHandler(self)
+        self.observer = Observer()
+        for directory in {os.path.dirname(self.products_file), os.path.dirname(self.orders_file)}:
+            if os.path.isdir(directory):
+                self.observer.schedule(handler, directory, recursive=False)
+        self.observer.daemon = True
+        self.observer.start()
+        logger.info("DATA: Watching product and order files for changes")
+
+class DataSourceEventHandler(FileSystemEventHandler):
+    """Routes file events for the watched data files to DataSources."""
+
+    def __init__(self, sources):
+        self.sources = sources
+
+    def on_any_event(self, event):
+        if event.is_directory or event.event_type not in ("modified", "created", "moved"):
+            return
+        for path in {event.src_path, getattr(event, 'dest_path', '')}:
+            path = os.path.abspath(path) if path else ''
+            if path == self.sources.products_file:
+                self.sources.reload_products()
+            elif path == self.sources.orders_file:
+                self.sources.reload_orders()
+
+@st.cache_resource
+def get_data_sources():
+    """Load product and order data once per process and keep it current with a file watcher."""
+    sources = DataSources(PRODUCTS_FILE, ORDERS_FILE, PRODUCTS_CATALOG_FILE)
+    try:
+        sources.start()
+    except Exception as e:
+        logger.error(f"DATA ERROR: File watcher unavailable, data reloads need a restart: {e}")
+    return sources
+
 # ============================================================================
 # UTILITY FUNCTIONS
 # ============================================================================
 
 def log_system_message(message):
     """Add a timestamped message to system logs."""
+    # Background threads without a session (e.g. timers) go to the process log instead
+    if get_script_run_ctx(suppress_warning=True) is None:
+        logger.info(message)
+        return
+
     if 'system_logs' not in st.session_state:
         st.session_state['system_logs'] = []
     
@@ -341,6 +811,10 @@ def init_database():
             priority TEXT NOT NULL
         )
         ''')
+        init_leads_search_index(conn)
+        init_transcript_tables(conn)
+        init_usage_table(conn)
+        init_profile_table(conn)
         conn.commit()
         conn.close()
         st.sidebar.success(f"✅ Connected to SQLite database: {DB_FILE}")
@@ -349,6 +823,166 @@ def init_database():
         st.sidebar.error(f"❌ Failed to initialize database: {e}")
         return False
 
+LEADS_FTS_DELETE_TRIGGER = '''
+CREATE TRIGGER IF NOT EXISTS leads_fts_ad AFTER DELETE ON leads BEGIN
+    INSERT INTO leads_fts(leads_fts, rowid, name, company, email, details)
+    VALUES ('delete', old.id, old.name, old.company, old.email, old.details);
+END
+'''
+
+def init_leads_search_index(conn):
+    """Create the FTS5 index mirroring the leads table and the triggers that keep it in sync."""
+    global LEADS_FTS_ENABLED
+    cursor = conn.cursor()
+    exists = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'leads_fts'"
+    ).fetchone()
+    try:
+        # External-content table: the text lives once in `leads`, FTS5 only stores the index
+        cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS leads_fts USING fts5(
+            name, company, email, details,
+            content='leads', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+        ''')
+    except sqlite3.OperationalError as e:
+        LEADS_FTS_ENABLED = False
+        log_system_message(f"DATABASE: FTS5 unavailable, lead search falls back to LIKE ({e})")
+        return
+
+    cursor.executescript('''
+    CREATE TRIGGER IF NOT EXISTS leads_fts_ai AFTER INSERT ON leads BEGIN
+        INSERT INTO leads_fts(rowid, name, company, email, details)
+        VALUES (new.id, new.name, new.company, new.email, new.details);
+    END;
+    CREATE TRIGGER IF NOT EXISTS leads_fts_au AFTER UPDATE ON leads BEGIN
+        INSERT INTO leads_fts(leads_fts, rowid, name, company, email, details)
+        VALUES ('delete', old.id, old.name, old.company, old.email, old.details);
+        INSERT INTO leads_fts(rowid, name, company, email, details)
+        VALUES (new.id, new.name, new.company, new.email, new.details);
+    END;
+    ''')
+    cursor.execute(LEADS_FTS_DELETE_TRIGGER)
+
+    # Backfill leads stored before the index existed
+    if not exists:
+        cursor.execute("INSERT INTO leads_fts(leads_fts) VALUES ('rebuild')")
+        log_system_message("DATABASE: Built full-text index for existing leads")
+    LEADS_FTS_ENABLED = True
+
+def build_fts_query(search_text):
+    """Turn free text into a safe FTS5 prefix query (every term must match)."""
+    terms = re.findall(r"\w+", search_text, re.UNICODE)
+    return " ".join(f'"{term}"*' for term in terms)
+
+def remove_expired_exports():
+    """Delete exports (and abandoned partial files) older than EXPORT_MAX_AGE; they contain lead PII."""
+    if not os.path.isdir(EXPORT_DIR):
+        return
+    now = time.time()
+    for entry in os.scandir(EXPORT_DIR):
+        try:
+            if entry.is_file() and now - entry.stat().st_mtime > EXPORT_MAX_AGE:
+                os.remove(entry.path)
+                logger.info(f"DATABASE: Removed expired export {entry.name}")
+        except OSError as e:
+            logger.error(f"DATABASE ERROR: Could not remove expired export {entry.name}: {e}")
+
+@st.cache_resource
+def start_export_cleanup():
+    """Sweep expired exports at startup and then every EXPORT_CLEANUP_INTERVAL, once per process."""
+    stop = threading.Event()
+
+    def run():
+        remove_expired_exports()
+        while not stop.wait(EXPORT_CLEANUP_INTERVAL):
+            remove_expired_exports()
+
+    threading.Thread(target=run, name="export-cleanup", daemon=True).start()
+    atexit.register(stop.set)
+    return stop
+
+def write_lead_export(fmt, lead_type=None):
+    """Stream an export of the leads table to a file in EXPORT_DIR; returns (path, bytes written).
+
+    The file name is random so that one user's export link cannot be guessed by another.
+    """
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    file_name, _ = EXPORT_FORMATS[fmt]
+    stem, extension = os.path.splitext(file_name)
+    export_path = os.path.join(EXPORT_DIR, f"{stem}_{uuid.uuid4().hex}{extension}")
+    partial_path = f"{export_path}.part"
+    try:
+        with open(partial_path, "wb") as f:
+            written = export_leads(DB_FILE, f, fmt, lead_type=lead_type)
+        os.replace(partial_path, export_path)
+    except BaseException:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+    return export_path, written
+
+def search_leads(search_text, limit=50):
+    """Search stored leads by name, company, email or details, best matches first."""
+    search_text = (search_text or "").strip()
+    if not search_text:
+        return pd.DataFrame()
+
+    try:
+        conn = sqlite3.connect(DB_FILE)
+        fts_query = build_fts_query(search_text)
+        if LEADS_FTS_ENABLED and fts_query:
+            df = pd.read_sql_query('''
+            SELECT leads.*, bm25(leads_fts, 10.0, 5.0, 5.0, 1.0) AS rank
+            FROM leads_fts
+            JOIN leads ON leads.id = leads_fts.rowid
+            WHERE leads_fts MATCH ?
+            ORDER BY rank
+            LIMIT ?
+            ''', conn, params=(fts_query, limit))
+        else:
+            # Escape LIKE wildcards so a search for "%" or "_" matches them literally
+            escaped = re.sub(r"([\\%_])", r"\\\1", search_text)
+            pattern = f"%{escaped}%"
+            df = pd.read_sql_query(r'''
+            SELECT * FROM leads
+            WHERE name LIKE ? ESCAPE '\' OR company LIKE ? ESCAPE '\'
+               OR email LIKE ? ESCAPE '\' OR details LIKE ? ESCAPE '\'
+            ORDER BY timestamp DESC
+            LIMIT ?
+            ''', conn, params=(pattern, pattern, pattern, pattern, limit))
+        conn.close()
+        log_system_message(f"DATABASE: Search '{search_text}' matched {len(df)} leads")
+        return df
+    except Exception as e:
+        error_msg = f"Error searching leads: {str(e)}"
+        log_system_message(f"DATABASE ERROR: {error_msg}")
+        return pd.DataFrame()
+
+def clear_all_leads():
+    """Delete every stored lead and empty the search index in one step."""
+    conn = sqlite3.connect(DB_FILE, isolation_level=None)
+    has_index = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'leads_fts'"
+    ).fetchone()
+    try:
+        conn.execute("BEGIN")
+        if has_index:
+            # Without the per-row delete trigger, clearing is one index operation instead of one per lead
+            conn.execute("DROP TRIGGER IF EXISTS leads_fts_ad")
+            conn.execute("DELETE FROM leads")
+            conn.execute("INSERT INTO leads_fts(leads_fts) VALUES ('delete-all')")
+            conn.execute(LEADS_FTS_DELETE_TRIGGER)
+        else:
+            conn.execute("DELETE FROM leads")
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
 def save_lead_to_database(lead_type, lead_name, company=None, email=None, phone=None, details=None, priority="normal"):
     """Save lead information to database."""
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -358,9 +992,10 @@ def save_lead_to_database(lead_type, lead_name, company=None, email=None, phone=
         conn = sqlite3.connect(DB_FILE)
         cursor = conn.cursor()
         cursor.execute('''
-        INSERT INTO leads (timestamp, lead_type, name, company, email, phone, details, priority)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (timestamp, lead_type, lead_name, company or "", email or "", phone or "", details or "", priority))
+        INSERT INTO leads (timestamp, lead_type, name, company, email, phone, details, priority, session_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (timestamp, lead_type, lead_name, company or "", email or "", phone or "", details or "", priority,
+              st.session_state.get('session_id')))
         conn.commit()
         conn.close()
         log_system_message(f"DATABASE: Lead successfully stored for {lead_name}")
@@ -385,6 +1020,135 @@ def get_all_leads():
         st.error(error_msg)
         return pd.DataFrame()
 
+# ============================================================================
+# TRANSCRIPT ARCHIVE
+# ============================================================================
+
+def init_transcript_tables(conn):
+    """Create the compressed transcript archive and link leads to the session that produced them."""
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(leads)")]
+    if 'session_id' not in columns:
+        conn.execute("ALTER TABLE leads ADD COLUMN session_id TEXT")
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS transcripts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        role TEXT NOT NULL,
+        timestamp TEXT NOT NULL,
+        codec TEXT NOT NULL,
+        content BLOB NOT NULL
+    )
+    ''')
+    # seq is the message's position in its session (archives created earlier called it `turn`)
+    if 'turn' in [row[1] for row in conn.execute("PRAGMA table_info(transcripts)")]:
+        conn.execute("DROP INDEX IF EXISTS transcripts_session_turn")
+        conn.execute("ALTER TABLE transcripts RENAME COLUMN turn TO seq")
+    conn.execute("CREATE INDEX IF NOT EXISTS transcripts_session_seq ON transcripts(session_id, seq)")
+    conn.execute("CREATE INDEX IF NOT EXISTS leads_session ON leads(session_id)")
+
+def compress_text(text):
+    """Compress text with zstd when available, otherwise zlib."""
+    data = text.encode('utf-8')
+    if zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor(level=10).compress(data)
+    return "zlib", zlib.compress(data, 9)
+
+def decompress_text(codec, blob):
+    if codec == "zstd":
+        if zstandard is None:
+            return "[zstd-compressed text; install zstandard to read it]"
+        return zstandard.ZstdDecompressor().decompress(blob).decode('utf-8')
+    return zlib.decompress(blob).decode('utf-8')
+
+def append_transcript_message(session_id, seq, role, content):
+    """Append one message to the archive (append-only; rows are never updated)."""
+    codec, blob = compress_text(content)
+    try:
+        conn = sqlite3.connect(DB_FILE)
+        conn.execute('''
+        INSERT INTO transcripts (session_id, seq, role, timestamp, codec, content)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ''', (session_id, seq, role, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), codec, blob))
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        log_system_message(f"TRANSCRIPT ERROR: Failed to archive {role} message {seq}: {str(e)}")
+
+def load_transcript(session_id, before_seq=None, limit=None):
+    """Load archived messages for a session in order, optionally only those before a position."""
+    query = "SELECT seq, role, timestamp, codec, content FROM transcripts WHERE session_id = ?"
+    params = [session_id]
+    if before_seq is not None:
+        query += " AND seq < ?"
+        params.append(before_seq)
+    query += " ORDER BY seq DESC"
+    if limit:
+        query += " LIMIT ?"
+        params.append(limit)
+
+    conn = sqlite3.connect(DB_FILE)
+    rows = conn.execute(query, params).fetchall()
+    conn.close()
+    return [
+        {"role": role, "content": decompress_text(codec, blob), "timestamp": timestamp, "seq": seq}
+        for seq, role, timestamp, codec, blob in reversed(rows)
+    ]
+
+def set_archived_messages_shown(count):
+    """Button callback: how many archived messages to show above the live window."""
+    st.session_state['archived_messages_shown'] = count
+
+def load_lead_transcript(lead_id):
+    """Full archived transcript of the session that produced a stored lead."""
+    conn = sqlite3.connect(DB_FILE)
+    row = conn.execute("SELECT session_id FROM leads WHERE id = ?", (lead_id,)).fetchone()
+    conn.close()
+    if not row or not row[0]:
+        return []
+    return load_transcript(row[0])
+
+LEAD_FACT_FIELDS = ("name", "company", "email", "phone")
+
+def update_lead_facts(content):
+    """Remember contact details from a user message so they outlive the live window.
+
+    The first value found for each field is kept, like extract_lead_details on the full conversation.
+    """
+    facts = st.session_state.setdefault('lead_facts', {})
+    extracted = extract_lead_details(content)
+    for field in LEAD_FACT_FIELDS:
+        value = extracted.get(field)
+        if value and value != "Unknown" and field not in facts:
+            facts[field] = value
+
+def add_session_message(role, content):
+    """Archive a message and keep only the most recent LIVE_TRANSCRIPT_MESSAGES in session state."""
+    seq = st.session_state.get('transcript_seq', 0) + 1
+    st.session_state['transcript_seq'] = seq
+    append_transcript_message(st.session_state['session_id'], seq, role, content)
+    if role == "user":
+        update_lead_facts(content)
+
+    messages = st.session_state['messages']
+    messages.append({"role": role, "content": content, "seq": seq})
+    overflow = len(messages) - LIVE_TRANSCRIPT_MESSAGES
+    if overflow > 0:
+        del messages[:overflow]
+
+def get_conversation_text():
+    """Conversation text for the agents: the live window, preceded by remembered lead details
+    once earlier messages have dropped out of it."""
+    speakers = {"user": "User", "assistant": "Assistant"}
+    messages = st.session_state.get('messages', [])
+    lines = [f"{speakers[m['role']]}: {m['content']}" for m in messages]
+
+    facts = st.session_state.get('lead_facts', {})
+    if facts and messages and messages[0].get("seq", 1) > 1:
+        summary = "; ".join(f"{field.title()}: {facts[field]}" for field in LEAD_FACT_FIELDS if field in facts)
+        lines.insert(0, f"(Earlier in this conversation the customer gave these details - {summary})")
+    return "\n".join(lines)
+
 # ============================================================================
 # EMAIL FUNCTIONS
 # ============================================================================
@@ -424,25 +1188,150 @@ def send_email_message(to_email, subject, body, cc=None, log_prefix="EMAIL"):
         log_system_message(f"{log_prefix}: ❌ {error_msg}")
         return error_msg
 
-def create_lead_email_body(lead_type, lead_name, company=None, email=None, phone=None, details=None, priority="normal"):
-    """Create HTML email body for lead notifications."""
-    return f"""
-    <h2>New {lead_type.title()} Lead ({priority.upper()} Priority)</h2>
-    <p><strong>Name:</strong> {lead_name}</p>
-    <p><strong>Company:</strong> {company or 'N/A'}</p>
-    <p><strong>Email:</strong> {email or 'N/A'}</p>
-    <p><strong>Phone:</strong> {phone or 'N/A'}</p>
-    <p><strong>Details:</strong> {details or 'N/A'}</p>
+EMAIL_TEMPLATES = {
+    "lead_fields.html": """
+    <p><strong>Name:</strong> {{ lead.lead_name }}</p>
+    <p><strong>Company:</strong> {{ lead.company or 'N/A' }}</p>
+    <p><strong>Email:</strong> {{ lead.email or 'N/A' }}</p>
+    <p><strong>Phone:</strong> {{ lead.phone or 'N/A' }}</p>
+    <p><strong>Details:</strong> {{ lead.details or 'N/A' }}</p>
+    """,
+    "lead.html": """
+    <h2>New {{ lead.lead_type|title }} Lead ({{ (lead.priority or 'normal')|upper }} Priority)</h2>
+    {% include "lead_fields.html" %}
     <hr>
     <p><em>This email was automatically generated by the Lead Qualification System.</em></p>
-    """
+    """,
+    "digest.html": """
+    <h2>{{ leads|length }} New Leads</h2>
+    <p>Received between {{ leads[0].received }} and {{ leads[-1].received }}.</p>
+    {% for lead in leads %}
+    <h3>{{ loop.index }}. {{ lead.lead_type|title }} Lead ({{ (lead.priority or 'normal')|upper }} Priority)</h3>
+    {% include "lead_fields.html" %}
+    {% endfor %}
+    <hr>
+    <p><em>This digest was automatically generated by the Lead Qualification System.</em></p>
+    """,
+}
+
+@st.cache_resource
+def get_email_templates():
+    """Jinja2 environment with every email template compiled once per process."""
+    env = Environment(loader=DictLoader(EMAIL_TEMPLATES), autoescape=select_autoescape(default=True))
+    for name in EMAIL_TEMPLATES:
+        env.get_template(name)  # compile now; the environment caches compiled templates
+    return env
+
+def make_lead_record(lead_type, lead_name, company=None, email=None, phone=None, details=None, priority="normal", **_):
+    """Normalize lead fields for templates and the digest queue."""
+    return {
+        "lead_type": lead_type,
+        "lead_name": lead_name,
+        "company": company,
+        "email": email,
+        "phone": phone,
+        "details": details,
+        "priority": priority or "normal",
+        "received": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+def create_lead_email_body(lead):
+    """Create HTML email body for a lead record from make_lead_record."""
+    return get_email_templates().get_template("lead.html").render(lead=lead)
+
+def create_digest_email_body(leads):
+    """Create HTML email body listing several leads."""
+    return get_email_templates().get_template("digest.html").render(leads=leads)
+
+def get_digest_window(lead_type):
+    """Digest window in seconds for a lead type (matched case-insensitively like EMAIL_ROUTING)."""
+    for key, window in EMAIL_DIGEST_WINDOWS.items():
+        if key.lower() == lead_type.lower():
+            return window
+    return EMAIL_DIGEST_WINDOW
+
+class LeadDigestQueue:
+    """Buffers leads per destination and sends one email when the destination's window closes."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._timers = {}
+
+    def add(self, destination, lead, window):
+        """Queue a lead; the first lead for a destination starts its window. Returns the batch size."""
+        with self._lock:
+            batch = self._pending.setdefault(destination, [])
+            batch.append(lead)
+            self._schedule(destination, window)
+            return len(batch)
+
+    def _schedule(self, destination, delay):
+        """Start the flush timer for a destination unless one is running (call with the lock held)."""
+        if destination not in self._timers:
+            timer = threading.Timer(delay, self.flush, args=(destination,))
+            timer.daemon = True
+            self._timers[destination] = timer
+            timer.start()
 
-def route_lead_email(lead_type, lead_name, **lead_info):
-    """Route lead to appropriate email address."""
+    def flush(self, destination):
+        """Send everything queued for a destination now."""
+        with self._lock:
+            leads = self._pending.pop(destination, [])
+            timer = self._timers.pop(destination, None)
+        if timer:
+            timer.cancel()
+        if not leads:
+            return None
+
+        if len(leads) == 1:
+            lead = leads[0]
+            subject = f"New {lead['lead_type'].title()} Lead: {lead['lead_name']}"
+            body = create_lead_email_body(lead)
+        else:
+            lead_types = sorted({lead['lead_type'].title() for lead in leads})
+            subject = f"{len(leads)} New Leads ({', '.join(lead_types)})"
+            body = create_digest_email_body(leads)
+        result = send_email_message(destination, subject, body, log_prefix="DIGEST")
+
+        if result.startswith("Failed to send email"):
+            # Put the batch back ahead of newer leads and try again later; nothing is dropped
+            with self._lock:
+                self._pending[destination] = leads + self._pending.get(destination, [])
+                self._schedule(destination, EMAIL_DIGEST_RETRY_DELAY)
+            logger.error(f"DIGEST ERROR: {len(leads)} lead(s) for {destination} requeued, "
+                         f"retrying in {EMAIL_DIGEST_RETRY_DELAY}s: {result}")
+        return result
+
+    def flush_all(self):
+        for destination in list(self._pending):
+            self.flush(destination)
+
+    def pending_counts(self):
+        with self._lock:
+            return {destination: len(leads) for destination, leads in self._pending.items()}
+
+@st.cache_resource
+def get_lead_digest_queue():
+    """One digest queue per process; anything still queued is sent on shutdown."""
+    queue = LeadDigestQueue()
+    atexit.register(queue.flush_all)
+    return queue
+
+def route_lead_email(lead_type, lead_name, immediate=False, **lead_info):
+    """Route lead to appropriate email address, batching it into a digest when configured."""
     destination = EMAIL_ROUTING.get(lead_type.lower(), EMAIL_USER)
+    lead = make_lead_record(lead_type, lead_name, **lead_info)
+
+    window = get_digest_window(lead_type)
+    if window > 0 and not immediate and lead["priority"].lower() not in EMAIL_IMMEDIATE_PRIORITIES:
+        pending = get_lead_digest_queue().add(destination, lead, window)
+        log_system_message(f"ROUTING: {lead_type} lead '{lead_name}' queued for digest to {destination} ({pending} pending)")
+        return f"Lead for {lead_name} queued for the next digest email to {destination}"
+
     subject = f"New {lead_type.title()} Lead: {lead_name}"
-    body = create_lead_email_body(lead_type, lead_name, **lead_info)
-    
+    body = create_lead_email_body(lead)
+
     log_system_message(f"ROUTING: {lead_type} lead '{lead_name}' to {destination}")
     return send_email_message(destination, subject, body, log_prefix="ROUTING")
 
@@ -515,6 +1404,33 @@ def send_test_email():
     else:
         st.sidebar.error(f"❌ Failed to send test email: {result}")
 
+# ============================================================================
+# ASYNC TOOL EXECUTION
+# ============================================================================
+
+@st.cache_resource
+def get_tool_executor():
+    """Thread pool shared by all sessions for blocking tool I/O."""
+    return ThreadPoolExecutor(max_workers=TOOL_EXECUTOR_WORKERS, thread_name_prefix="tool-io")
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking call on the tool executor so the event loop stays free."""
+    ctx = get_script_run_ctx(suppress_warning=True)
+
+    def call():
+        # Keep system logs attached to the session that issued the tool call
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return func(*args, **kwargs)
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_tool_executor(), call)
+
+def record_turn_latency(seconds):
+    """Keep per-session turn latencies, tagged with the tool mode, for before/after comparison."""
+    mode = "async" if ASYNC_TOOLS_ENABLED else "sync"
+    st.session_state.setdefault('turn_latencies', []).append({"mode": mode, "seconds": seconds})
+    log_system_message(f"PROCESSING: Turn completed in {seconds:.2f}s ({mode} tools)")
+
 # ============================================================================
 # AGENT TOOL FUNCTIONS
 # ============================================================================
@@ -534,6 +1450,396 @@ def store_lead_in_database(lead_type: str, lead_name: str, company: str = None,
     """Store lead in database tool for agents."""
     return save_lead_to_database(lead_type, lead_name, company, email, phone, details, priority)
 
+# Async variants: same names and schemas as above, but blocking work runs on the tool executor,
+# so tool calls issued together in one model step execute concurrently.
+
+@function_tool(name_override="send_email")
+async def send_email_async(to_email: str, subject: str, body: str, cc: str = None) -> str:
+    """Send email tool for agents."""
+    return await run_blocking(send_email_message, to_email, subject, body, cc)
+
+@function_tool(name_override="route_lead_to_email")
+async def route_lead_to_email_async(lead_type: str, lead_name: str, company: str = None, email: str = None, phone: str = None, details: str = None, priority: str = "normal") -> str:
+    """Route lead to appropriate email tool for agents."""
+    return await run_blocking(route_lead_email, lead_type, lead_name, company=company, email=email, phone=phone, details=details, priority=priority)
+
+@function_tool(name_override="store_lead_in_database")
+async def store_lead_in_database_async(lead_type: str, lead_name: str, company: str = None, email: str = None, phone: str = None, details: str = None, priority: str = "normal") -> str:
+    """Store lead in database tool for agents."""
+    return await run_blocking(save_lead_to_database, lead_type, lead_name, company, email, phone, details, priority)
+
+@function_tool(name_override="lookup_order")
+async def lookup_order_async(search_term: str) -> str:
+    """Look up order information by order ID, customer name, or phone number."""
+    return await run_blocking(find_order_details, search_term)
+
+# ============================================================================
+# MODEL CALL GOVERNOR
+# ============================================================================
+
+def estimate_tokens(*parts):
+    """Rough token estimate (~4 characters per token) used for budgeting only."""
+    chars = 0
+    for part in parts:
+        if part is None:
+            continue
+        chars += len(part) if isinstance(part, str) else len(json.dumps(part, default=str))
+    return chars // 4 + 1
+
+class ModelCallGovernor:
+    """Process-wide limiter for model calls.
+
+    Enforces a concurrency cap plus request and token budgets per minute (token buckets),
+    and coalesces identical in-flight calls so they share one response. It is thread-safe
+    because every Streamlit session runs its own event loop on its own thread.
+    """
+
+    def __init__(self, max_concurrency, requests_per_minute, tokens_per_minute):
+        self.max_concurrency = max_concurrency
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._lock = threading.Lock()
+        self._request_allowance = float(requests_per_minute)
+        self._token_allowance = float(tokens_per_minute)
+        self._last_refill = time.monotonic()
+        self._inflight_calls = {}
+        self._waits = deque(maxlen=500)
+        self.in_flight = 0
+        self.queued = 0
+        self.coalesced = 0
+        self.retries = 0
+        self.rate_limited = 0
+
+    def _refill(self, now):
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._request_allowance = min(self.requests_per_minute,
+                                      self._request_allowance + elapsed * self.requests_per_minute / 60)
+        self._token_allowance = min(self.tokens_per_minute,
+                                    self._token_allowance + elapsed * self.tokens_per_minute / 60)
+
+    def _try_acquire(self, tokens):
+        """Take a slot if possible; otherwise return how long to wait before trying again."""
+        with self._lock:
+            self._refill(time.monotonic())
+            tokens = min(tokens, self.tokens_per_minute)  # an oversized call must still be able to run
+            if self.in_flight >= self.max_concurrency:
+                return 0.05
+            wait = max(
+                (1 - self._request_allowance) * 60 / self.requests_per_minute,
+                (tokens - self._token_allowance) * 60 / self.tokens_per_minute,
+            )
+            if wait > 0:
+                return wait
+            self._request_allowance -= 1
+            self._token_allowance -= tokens
+            self.in_flight += 1
+            return 0
+
+    async def acquire(self, tokens):
+        started = time.monotonic()
+        with self._lock:
+            self.queued += 1
+        try:
+            while True:
+                wait = self._try_acquire(tokens)
+                if not wait:
+                    break
+                await asyncio.sleep(min(wait, 1.0))
+        finally:
+            with self._lock:
+                self.queued -= 1
+        waited = time.monotonic() - started
+        with self._lock:
+            self._waits.append(waited)
+        return waited
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def penalize(self):
+        """Drain the buckets after a 429 so every session backs off, not just the one that was throttled."""
+        with self._lock:
+            self.rate_limited += 1
+            self._request_allowance = min(self._request_allowance, 0.0)
+            self._token_allowance = min(self._token_allowance, 0.0)
+
+    async def call(self, key, tokens, make_call):
+        """Run make_call() under the budget, with retries, sharing the result with identical callers.
+
+        Returns (result, coalesced) where coalesced is True when another caller's result was reused.
+        """
+        with self._lock:
+            shared = self._inflight_calls.get(key)
+            leader = shared is None
+            if leader:
+                shared = self._inflight_calls[key] = concurrent.futures.Future()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            # Shield so a cancelled follower cannot cancel the leader's shared future
+            return await asyncio.shield(asyncio.wrap_future(shared)), True
+
+        try:
+            result = await self._call_with_retry(tokens, make_call)
+        except BaseException as e:
+            shared.set_exception(e)
+            raise
+        else:
+            shared.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                self._inflight_calls.pop(key, None)
+
+    async def _call_with_retry(self, tokens, make_call):
+        async for attempt in AsyncRetrying(
+            retry=retry_if_exception_type(RETRYABLE_MODEL_ERRORS),
+            wait=wait_random_exponential(multiplier=1, max=30),
+            stop=stop_after_attempt(MODEL_RETRY_ATTEMPTS),
+            before_sleep=self._before_retry,
+            reraise=True,
+        ):
+            with attempt:
+                await self.acquire(tokens)
+                try:
+                    return await make_call()
+                finally:
+                    self.release()
+
+    def _before_retry(self, retry_state):
+        error = retry_state.outcome.exception()
+        with self._lock:
+            self.retries += 1
+        if isinstance(error, openai.RateLimitError):
+            self.penalize()
+        logger.warning(f"MODEL: Retrying after {type(error).__name__} (attempt {retry_state.attempt_number})")
+
+    def stats(self):
+        with self._lock:
+            waits = sorted(self._waits)
+            return {
+                "queue_depth": self.queued,
+                "in_flight": self.in_flight,
+                "avg_wait_s": sum(waits) / len(waits) if waits else 0.0,
+                "p95_wait_s": waits[int(len(waits) * 0.95)] if waits else 0.0,
+                "max_wait_s": waits[-1] if waits else 0.0,
+                "coalesced": self.coalesced,
+                "retries": self.retries,
+                "rate_limited": self.rate_limited,
+            }
+
+class GovernedModel(Model):
+    """Model wrapper that routes every call through the ModelCallGovernor."""
+
+    def __init__(self, model, model_name, governor, calls):
+        self.model = model
+        self.model_name = model_name or USAGE_DEFAULT_MODEL
+        self.governor = governor
+        self.calls = calls
+
+    async def get_response(self, system_instructions, input, model_settings, tools, output_schema,
+                           handoffs, tracing, **kwargs):
+        key = hashlib.sha256(json.dumps(
+            [self.model_name, system_instructions, input, model_settings.to_json_dict(),
+             [tool.name for tool in tools], [h.tool_name for h in handoffs], kwargs],
+            default=str, sort_keys=True,
+        ).encode()).hexdigest()
+        tokens = estimate_tokens(system_instructions, input) + MODEL_OUTPUT_TOKEN_ESTIMATE
+
+        async def make_call():
+            return await self.model.get_response(system_instructions, input, model_settings, tools,
+                                                 output_schema, handoffs, tracing, **kwargs)
+
+        started = time.perf_counter()
+        response, coalesced = await self.governor.call(key, tokens, make_call)
+        self.calls.append({
+            "response": response,
+            "model": self.model_name,
+            "latency_ms": int((time.perf_counter() - started) * 1000),
+            "coalesced": coalesced,
+        })
+        return response
+
+    async def stream_response(self, system_instructions, input, *args, **kwargs):
+        # Streams are budgeted but neither retried nor coalesced
+        await self.governor.acquire(estimate_tokens(system_instructions, input) + MODEL_OUTPUT_TOKEN_ESTIMATE)
+        try:
+            async for event in self.model.stream_response(system_instructions, input, *args, **kwargs):
+                yield event
+        finally:
+            self.governor.release()
+
+class GovernedModelProvider(ModelProvider):
+    """Resolves models as usual and wraps them in GovernedModel.
+
+    One provider is created per run; `calls` collects every model call of that run in order.
+    """
+
+    def __init__(self, governor):
+        self.governor = governor
+        # Client-side retries are off so every retry goes through the governor's budget and backoff
+        self.provider = MultiProvider(openai_client=openai.AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0))
+        self.calls = []
+
+    def get_model(self, model_name):
+        return GovernedModel(self.provider.get_model(model_name), model_name, self.governor, self.calls)
+
+@st.cache_resource
+def get_model_governor():
+    """One governor per process, shared by all sessions."""
+    return ModelCallGovernor(MODEL_MAX_CONCURRENCY, MODEL_REQUESTS_PER_MINUTE, MODEL_TOKENS_PER_MINUTE)
+
+def get_governed_run_config():
+    return RunConfig(model_provider=GovernedModelProvider(get_model_governor()))
+
+# ============================================================================
+# USAGE ACCOUNTING
+# ============================================================================
+
+def init_usage_table(conn):
+    """Create the per-model-call usage table."""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS usage_log (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        timestamp TEXT NOT NULL,
+        session_id TEXT NOT NULL,
+        request_id TEXT NOT NULL,
+        agent TEXT NOT NULL,
+        round INTEGER NOT NULL,
+        model TEXT NOT NULL,
+        input_tokens INTEGER NOT NULL,
+        cached_tokens INTEGER NOT NULL,
+        output_tokens INTEGER NOT NULL,
+        latency_ms INTEGER NOT NULL,
+        coalesced INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS usage_log_session ON usage_log(session_id)")
+
+def estimate_cost(model, input_tokens, cached_tokens, output_tokens):
+    """Estimated USD cost of one model call; cached input tokens are billed at the cached rate."""
+    input_price, cached_price, output_price = MODEL_PRICING.get(model, MODEL_PRICING["gpt-4o"])
+    return ((input_tokens - cached_tokens) * input_price
+            + cached_tokens * cached_price
+            + output_tokens * output_price) / 1_000_000
+
+def attribute_calls_to_agents(new_items, calls, last_agent_name=None):
+    """Work out which agent made each model call, using the output item ids of the run.
+
+    Calls after the last one with a matching item go to last_agent_name when it is known,
+    e.g. the agent that was running when the run raised.
+    """
+    agent_by_item_id = {}
+    for item in new_items:
+        item_id = getattr(item.raw_item, 'id', None)
+        if item_id:
+            agent_by_item_id[item_id] = item.agent.name
+
+    # A call with no matching items (e.g. only reasoning) belongs to the agent that was active before it
+    agent_name = st.session_state['lead_qualifier'].name
+    agents_for_calls = []
+    last_matched = -1
+    for index, call in enumerate(calls):
+        for output in call["response"].output:
+            if getattr(output, 'id', None) in agent_by_item_id:
+                agent_name = agent_by_item_id[output.id]
+                last_matched = index
+                break
+        agents_for_calls.append(agent_name)
+    if last_agent_name:
+        agents_for_calls[last_matched + 1:] = [last_agent_name] * (len(calls) - last_matched - 1)
+    return agents_for_calls
+
+def save_usage_records(rows):
+    """Insert usage rows for one turn."""
+    try:
+        conn = sqlite3.connect(DB_FILE)
+        conn.executemany('''
+        INSERT INTO usage_log (timestamp, session_id, request_id, agent, round, model,
+                               input_tokens, cached_tokens, output_tokens, latency_ms, coalesced)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        log_system_message(f"USAGE ERROR: Failed to store usage: {str(e)}")
+
+async def record_run_usage(calls, request_id, new_items=(), last_agent=None):
+    """Record input, cached-input and output tokens for every model call (tool round) of a turn.
+
+    Also called for runs that raised, with whatever items and last agent the run got to.
+    """
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    session_id = st.session_state['session_id']
+    rows = []
+    totals = {"input": 0, "cached": 0, "output": 0, "cost": 0.0}
+    for round_number, (call, agent_name) in enumerate(zip(calls, attribute_calls_to_agents(
+            new_items, calls, last_agent.name if last_agent else None)), 1):
+        usage = call["response"].usage
+        cached = usage.input_tokens_details.cached_tokens or 0
+        rows.append((timestamp, session_id, request_id, agent_name, round_number, call["model"],
+                     usage.input_tokens, cached, usage.output_tokens, call["latency_ms"], int(call["coalesced"])))
+        if not call["coalesced"]:
+            totals["input"] += usage.input_tokens
+            totals["cached"] += cached
+            totals["output"] += usage.output_tokens
+            totals["cost"] += estimate_cost(call["model"], usage.input_tokens, cached, usage.output_tokens)
+
+    await run_blocking(save_usage_records, rows)
+    log_system_message(
+        f"USAGE: {len(rows)} model call(s), {totals['input']} in ({totals['cached']} cached) / "
+        f"{totals['output']} out, ~${totals['cost']:.4f}"
+    )
+
+def get_usage_breakdown(group_by, session_id=None, limit=20):
+    """Aggregate token usage, cache hit rate, cost and latency by agent, request_id or session_id."""
+    where = "WHERE session_id = ?" if session_id else ""
+    conn = sqlite3.connect(DB_FILE)
+    df = pd.read_sql_query(f'''
+    SELECT {group_by}, model, coalesced,
+           COUNT(*) AS calls,
+           SUM(input_tokens) AS input_tokens,
+           SUM(cached_tokens) AS cached_tokens,
+           SUM(output_tokens) AS output_tokens,
+           SUM(latency_ms) AS latency_ms
+    FROM usage_log
+    {where}
+    GROUP BY {group_by}, model, coalesced
+    ''', conn, params=(session_id,) if session_id else ())
+    conn.close()
+
+    # Coalesced calls reused another caller's response, so they cost nothing
+    df["cost_usd"] = [0.0 if coalesced else estimate_cost(model, i, c, o) for model, coalesced, i, c, o in
+                      zip(df["model"], df["coalesced"], df["input_tokens"], df["cached_tokens"], df["output_tokens"])]
+    df = df.drop(columns=["model", "coalesced"]).groupby(group_by, as_index=False).sum()
+    df["cache_hit_pct"] = (100 * df["cached_tokens"] / df["input_tokens"].where(df["input_tokens"] > 0)).fillna(0).round(1)
+    df["avg_latency_ms"] = (df.pop("latency_ms") / df["calls"]).round(0)
+    df["cost_usd"] = df["cost_usd"].round(4)
+    return df.sort_values("cost_usd", ascending=False).head(limit)
+
+def render_usage_panel():
+    """Sidebar breakdown of token usage and cost."""
+    with st.sidebar.expander("💰 Token Usage & Cost"):
+        try:
+            session_df = get_usage_breakdown("agent", st.session_state.get('session_id'))
+            st.caption("This session, by agent")
+            st.dataframe(session_df, use_container_width=True, hide_index=True)
+
+            st.caption("This session, by turn")
+            st.dataframe(get_usage_breakdown("request_id", st.session_state.get('session_id')),
+                         use_container_width=True, hide_index=True)
+
+            st.caption("All sessions, by agent")
+            st.dataframe(get_usage_breakdown("agent"), use_container_width=True, hide_index=True)
+
+            st.caption("Most expensive sessions")
+            st.dataframe(get_usage_breakdown("session_id", limit=10), use_container_width=True, hide_index=True)
+        except Exception as e:
+            st.info(f"No usage recorded yet ({e})")
+
 # ============================================================================
 # AGENT HANDOFF CALLBACKS
 # ============================================================================
@@ -551,11 +1857,16 @@ def create_handoff_callback(lead_type):
                 conversation = "\n".join(msg.content for msg in ctx.messages if hasattr(msg, 'content'))
             
             # Add session conversation history if available
-            if 'conversation_history' in st.session_state:
-                conversation = f"{conversation}\n{st.session_state['conversation_history']}" if conversation else st.session_state['conversation_history']
+            session_conversation = get_conversation_text()
+            if session_conversation:
+                conversation = f"{conversation}\n{session_conversation}" if conversation else session_conversation
             
             # Extract lead details
             lead_details = extract_lead_details(conversation)
+            # Details given before the live window started are only in the remembered lead facts
+            for field, value in st.session_state.get('lead_facts', {}).items():
+                if not lead_details.get(field) or lead_details[field] == "Unknown":
+                    lead_details[field] = value
             log_system_message(f"HANDOFF: Extracted {lead_type} lead details: {lead_details}")
             
             # Different behavior based on lead type
@@ -644,7 +1955,7 @@ def create_agent_system():
         
         # Add order lookup tool specifically for orderlookup_agent
         if agent_type == "orderlookup_agent":
-            tools.append(lookup_order)
+            tools.append(lookup_order_async if ASYNC_TOOLS_ENABLED else lookup_order)
         
         agents[agent_type] = Agent(
             name=f"{agent_type.title()}LeadAgent",
@@ -652,6 +1963,11 @@ def create_agent_system():
             tools=tools
         )
     
+    if ASYNC_TOOLS_ENABLED:
+        lead_tools = [route_lead_to_email_async, store_lead_in_database_async, send_email_async]
+    else:
+        lead_tools = [route_lead_to_email, store_lead_in_database, send_email]
+
     # Create lead qualifier with handoffs
     lead_qualifier = Agent(
         name="LeadQualifier",
@@ -679,7 +1995,8 @@ def create_agent_system():
             handoff(agents["product_recommendations_agent"], on_handoff=create_handoff_callback("Product recommendations")),
             handoff(agents["orderlookup_agent"], on_handoff=create_handoff_callback("orderlookup"))
         ],
-        tools=[route_lead_to_email, store_lead_in_database, send_email]
+        tools=lead_tools,
+        model_settings=ModelSettings(parallel_tool_calls=True)
     )
     
     return lead_qualifier
@@ -688,18 +2005,14 @@ def create_agent_system():
 # MESSAGE PROCESSING
 # ============================================================================
 
-async def process_user_message(user_input):
+async def process_user_message(user_input, request_id=None):
     """Process user message through the agent system."""
-    # Initialize conversation history
-    if 'conversation_history' not in st.session_state:
-        st.session_state['conversation_history'] = ""
-    
-    # Update conversation history
-    if st.session_state['conversation_history']:
-        st.session_state['conversation_history'] += f"\nUser: {user_input}"
-    else:
-        st.session_state['conversation_history'] = user_input
-    
+    request_id = request_id or uuid.uuid4().hex[:12]
+    st.session_state['chat_request_id'] = request_id
+
+    # Archive the message and add it to the live window
+    await run_blocking(add_session_message, "user", user_input)
+
     log_system_message(f"PROCESSING: New message: {user_input[:50]}...")
     
     try:
@@ -710,24 +2023,249 @@ async def process_user_message(user_input):
         
         # Process through agent system
         log_system_message("PROCESSING: Running through lead qualifier")
+        run_config = get_governed_run_config()
         with st.spinner('Processing your message...'):
-            result = await Runner.run(st.session_state['lead_qualifier'], st.session_state['conversation_history'])
+            started = time.perf_counter()
+            new_items, last_agent = (), None
+            try:
+                result = await Runner.run(
+                    st.session_state['lead_qualifier'],
+                    get_conversation_text(),
+                    run_config=run_config
+                )
+                new_items, last_agent = result.new_items, result.last_agent
+                record_turn_latency(time.perf_counter() - started)
+            except AgentsException as e:
+                # e.g. MaxTurnsExceeded: keep what the run got to so its model calls are still attributed
+                if e.run_data:
+                    new_items, last_agent = e.run_data.new_items, e.run_data.last_agent
+                raise
+            finally:
+                # Runs that raise (max turns, rate limits after retries) are the ones most worth accounting for
+                if run_config.model_provider.calls:
+                    await record_run_usage(run_config.model_provider.calls, request_id, new_items, last_agent)
         
         # Get and store response
         response = result.final_output
         log_system_message(f"PROCESSING: Generated response: {response[:50]}...")
         
         # Update conversation and message history
-        st.session_state['conversation_history'] += f"\nAssistant: {response}"
-        st.session_state['messages'].append({"role": "user", "content": user_input})
-        st.session_state['messages'].append({"role": "assistant", "content": response})
+        await run_blocking(add_session_message, "assistant", response)
         
         return response
         
+    except openai.RateLimitError as e:
+        log_system_message(f"PROCESSING ERROR: Rate limited after {MODEL_RETRY_ATTEMPTS} attempts: {str(e)}")
+        response = "We're receiving a lot of messages right now. Please wait a moment and send your message again."
     except Exception as e:
         error_msg = f"Error processing message: {str(e)}"
         log_system_message(f"PROCESSING ERROR: {error_msg}")
-        return "I apologize, but there was an error processing your message. Please try again."
+        response = "I apologize, but there was an error processing your message. Please try again."
+
+    # render_app only reruns, so the user sees the fallback only if it is in the message history
+    await run_blocking(add_session_message, "assistant", response)
+    return response
+
+# ============================================================================
+# REQUEST PROFILING
+# ============================================================================
+
+def init_profile_table(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS profiles (
+        request_id TEXT PRIMARY KEY,
+        timestamp TEXT NOT NULL,
+        session_id TEXT,
+        label TEXT NOT NULL,
+        duration_ms INTEGER NOT NULL,
+        samples INTEGER NOT NULL,
+        top_functions TEXT NOT NULL,
+        codec TEXT NOT NULL,
+        collapsed BLOB NOT NULL
+    )
+    ''')
+
+def frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class StackSampler:
+    """Samples the stacks of every thread working for one session into collapsed-stack counts.
+
+    That is the script thread plus any tool executor thread carrying the same script run context.
+    """
+
+    def __init__(self, ctx, interval=PROFILE_SAMPLE_INTERVAL):
+        self.ctx = ctx
+        self.interval = interval
+        self.counts = {}
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        app_file = os.path.basename(__file__)
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            for thread in threading.enumerate():
+                if getattr(thread, SCRIPT_RUN_CONTEXT_ATTR_NAME, None) is not self.ctx:
+                    continue
+                frame = frames.get(thread.ident)
+                stack = []
+                while frame is not None:
+                    stack.append(frame_label(frame.f_code))
+                    frame = frame.f_back
+                # Idle executor threads never reach app code; leave them out
+                if thread.name.startswith("tool-io") and not any(app_file in label for label in stack):
+                    continue
+                key = ";".join([thread.name] + stack[::-1])
+                self.counts[key] = self.counts.get(key, 0) + 1
+            self.samples += 1
+
+class RequestProfiler:
+    """cProfile (script thread) plus stack sampling (script and tool threads) for one request."""
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.profile = cProfile.Profile()
+        self.sampler = StackSampler(get_script_run_ctx(suppress_warning=True))
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        self.sampler.start()
+        self.profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Also runs for st.rerun()/st.stop(), which end a request by raising
+        self.profile.disable()
+        self.sampler.stop()
+        duration_ms = int((time.perf_counter() - self.started) * 1000)
+        try:
+            save_request_profile(self, duration_ms)
+        except Exception as e:
+            logger.error(f"PROFILE ERROR: Failed to store profile {self.request_id}: {e}")
+        return False
+
+    def top_functions(self, limit=PROFILE_TOP_FUNCTIONS):
+        stats = pstats.Stats(self.profile)
+        rows = []
+        for (filename, lineno, name), (_, ncalls, tottime, cumtime, _) in stats.stats.items():
+            rows.append({
+                "function": f"{name} ({os.path.basename(filename)}:{lineno})",
+                "calls": ncalls,
+                "own_ms": round(tottime * 1000, 2),
+                "cumulative_ms": round(cumtime * 1000, 2),
+            })
+        rows.sort(key=lambda row: row["cumulative_ms"], reverse=True)
+        return rows[:limit]
+
+def save_request_profile(profiler, duration_ms):
+    label = "chat turn" if st.session_state.get('chat_request_id') == profiler.request_id else "render"
+    collapsed = "\n".join(f"{stack} {count}" for stack, count in profiler.sampler.counts.items())
+    codec, blob = compress_text(collapsed)
+    conn = sqlite3.connect(DB_FILE)
+    conn.execute('''
+    INSERT OR REPLACE INTO profiles (request_id, timestamp, session_id, label, duration_ms, samples,
+                                     top_functions, codec, collapsed)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (profiler.request_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), st.session_state.get('session_id'),
+          label, duration_ms, profiler.sampler.samples, json.dumps(profiler.top_functions()), codec, blob))
+    # Every rerun is a request, so without a cap PROFILE_REQUESTS=1 grows the table without bound
+    conn.execute('''
+    DELETE FROM profiles WHERE rowid <= (SELECT rowid FROM profiles ORDER BY rowid DESC LIMIT 1 OFFSET ?)
+    ''', (PROFILE_RETENTION,))
+    conn.commit()
+    conn.close()
+    log_system_message(f"PROFILE: Captured {label} {profiler.request_id} ({duration_ms} ms)")
+
+def should_profile_request():
+    """Profile when enabled by env var or sidebar toggle, or for 1 in PROFILE_SAMPLE_RATE requests."""
+    if PROFILE_REQUESTS or st.session_state.get('profile_requests'):
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.randrange(PROFILE_SAMPLE_RATE) == 0
+
+def request_profiler(request_id):
+    return RequestProfiler(request_id) if should_profile_request() else contextlib.nullcontext()
+
+def get_recent_profiles(limit=20):
+    conn = sqlite3.connect(DB_FILE)
+    df = pd.read_sql_query('''
+    SELECT request_id, timestamp, label, duration_ms, samples FROM profiles
+    ORDER BY timestamp DESC LIMIT ?
+    ''', conn, params=(limit,))
+    conn.close()
+    return df
+
+def load_request_profile(request_id):
+    conn = sqlite3.connect(DB_FILE)
+    row = conn.execute("SELECT top_functions, codec, collapsed FROM profiles WHERE request_id = ?",
+                       (request_id,)).fetchone()
+    conn.close()
+    top_functions, codec, blob = row
+    return json.loads(top_functions), decompress_text(codec, blob)
+
+def flamegraph_rects(collapsed):
+    """Lay out collapsed stacks ("a;b;c count" lines) as flamegraph rectangles."""
+    root = {"count": 0, "children": {}}
+    for line in collapsed.splitlines():
+        stack, _, count = line.rpartition(" ")
+        node = root
+        for frame in stack.split(";"):
+            node = node["children"].setdefault(frame, {"count": 0, "children": {}})
+            node["count"] += int(count)
+
+    rects = []
+    pending = [(root, 0, 0)]
+    while pending:
+        node, depth, x0 = pending.pop()
+        for name, child in sorted(node["children"].items()):
+            rects.append({"frame": name, "depth": depth, "x0": x0, "x1": x0 + child["count"], "samples": child["count"]})
+            pending.append((child, depth + 1, x0))
+            x0 += child["count"]
+    return pd.DataFrame(rects)
+
+def render_diagnostics_panel():
+    """Sidebar page with captured profiles: top functions, flamegraph and collapsed stacks."""
+    with st.sidebar.expander("🔬 Diagnostics"):
+        st.toggle("Profile my requests", key='profile_requests')
+        try:
+            profiles = get_recent_profiles()
+        except Exception as e:
+            st.info(f"No profiles captured yet ({e})")
+            return
+        if profiles.empty:
+            st.info("No profiles captured yet.")
+            return
+
+        options = {f"{row.request_id} · {row.label} · {row.duration_ms} ms": row.request_id
+                   for row in profiles.itertuples()}
+        request_id = options[st.selectbox("Request", list(options))]
+        top_functions, collapsed = load_request_profile(request_id)
+
+        st.caption("Top functions by cumulative time")
+        st.dataframe(pd.DataFrame(top_functions), use_container_width=True, hide_index=True)
+
+        rects = flamegraph_rects(collapsed)
+        if not rects.empty:
+            st.caption("Flamegraph (stack samples)")
+            chart = alt.Chart(rects).mark_rect(stroke="white").encode(
+                x=alt.X("x0:Q", axis=None),
+                x2="x1:Q",
+                y=alt.Y("depth:O", axis=None, sort="descending"),
+                color=alt.Color("frame:N", legend=None),
+                tooltip=["frame", "samples"],
+            ).properties(height=max(120, 12 * (int(rects["depth"].max()) + 1)))
+            st.altair_chart(chart, use_container_width=True)
+
+        st.download_button("⬇️ Collapsed stacks", data=collapsed, file_name=f"profile-{request_id}.folded",
+                           mime="text/plain")
 
 # ============================================================================
 # STREAMLIT UI
@@ -753,21 +2291,50 @@ def render_sidebar():
         if st.sidebar.button("📤 Test Email Routing"):
             results = []
             for lead_type in ["wholesale", "Product recommendations", "orderlookup"]:
-                result = route_lead_email(lead_type, f"Test {lead_type.title()} Lead")
+                result = route_lead_email(lead_type, f"Test {lead_type.title()} Lead", immediate=True)
                 results.append("successfully" in result)
             
             if all(results):
                 st.sidebar.success("✅ Test emails sent successfully!")
             else:
                 st.sidebar.error("❌ Some test emails failed. Check logs.")
+
+        pending = get_lead_digest_queue().pending_counts()
+        if pending:
+            st.sidebar.caption(f"📬 Leads waiting for digest: {sum(pending.values())}")
+            if st.sidebar.button("📨 Send Pending Digests Now"):
+                get_lead_digest_queue().flush_all()
+                st.sidebar.success("✅ Pending digests sent")
     else:
         st.sidebar.warning("⚠️ Email sending disabled")
         st.sidebar.info("Add EMAIL_USER and EMAIL_APP_PASSWORD to .env file")
     
+    # Turn latency, split by tool mode (ASYNC_TOOLS=0 gives the synchronous baseline)
+    latencies = st.session_state.get('turn_latencies', [])
+    if latencies:
+        df = pd.DataFrame(latencies).groupby("mode")["seconds"].agg(["count", "mean", "max"])
+        st.sidebar.caption("⏱️ Turn latency (seconds)")
+        st.sidebar.dataframe(df.round(2), use_container_width=True)
+
+    # Shared model capacity, for sizing the budgets above
+    with st.sidebar.expander("🚦 Model Capacity"):
+        stats = get_model_governor().stats()
+        st.metric("Queue depth", stats["queue_depth"])
+        st.metric("In flight", f"{stats['in_flight']} / {MODEL_MAX_CONCURRENCY}")
+        st.metric("Avg / p95 wait", f"{stats['avg_wait_s']:.2f}s / {stats['p95_wait_s']:.2f}s")
+        st.caption(f"Coalesced: {stats['coalesced']} · Retries: {stats['retries']} · 429s: {stats['rate_limited']}")
+
+    render_usage_panel()
+    render_diagnostics_panel()
+
     # Control buttons
     if st.sidebar.button("🔄 Reset Conversation"):
+        # The old session stays in the transcript archive under its own session ID
         st.session_state['messages'] = []
-        st.session_state['conversation_history'] = ""
+        st.session_state['transcript_seq'] = 0
+        st.session_state['lead_facts'] = {}
+        st.session_state['session_id'] = uuid.uuid4().hex
+        st.session_state.pop('archived_messages_shown', None)
         log_system_message("SYSTEM: Conversation reset")
         st.rerun()
     
@@ -780,33 +2347,104 @@ def render_sidebar():
             st.sidebar.dataframe(df, use_container_width=True)
         else:
             st.sidebar.info("No leads found in database.")
-    
-    if st.sidebar.button("📤 Export Leads to JSON"):
-        df = get_all_leads()
+
+    search_text = st.sidebar.text_input("🔎 Search Leads", placeholder="Name, company, email or details")
+    if search_text:
+        df = search_leads(search_text)
         if not df.empty:
-            json_data = df.to_json(orient="records", indent=4)
-            st.sidebar.download_button(
-                label="📋 Download JSON",
-                data=json_data,
-                file_name="leads_export.json",
-                mime="application/json"
-            )
+            st.sidebar.dataframe(df, use_container_width=True)
         else:
-            st.sidebar.info("No leads to export.")
-    
+            st.sidebar.info(f"No leads match '{search_text}'.")
+
+    export_format = st.sidebar.selectbox("Export format", available_export_formats())
+    export_type = st.sidebar.selectbox("Lead type", ["All", "wholesale", "Product recommendations", "orderlookup"])
+    if st.sidebar.button("📤 Export Leads"):
+        try:
+            export_path, written = write_lead_export(export_format, None if export_type == "All" else export_type)
+        except (OSError, RuntimeError, sqlite3.Error) as e:
+            st.sidebar.error(f"Export failed: {e}")
+            log_system_message(f"DATABASE ERROR: Export failed: {e}")
+        else:
+            log_system_message(f"DATABASE: Exported {written} bytes of leads as {export_format}")
+            file_name, _ = EXPORT_FORMATS[export_format]
+            if written > MAX_APP_STATIC_FILE_SIZE:
+                # Streamlit refuses to serve static files this large, so a link would only 404
+                command = f"python lead_export.py --format {export_format} -o {file_name}"
+                if export_type != "All":
+                    command += f' --lead-type "{export_type}"'
+                st.sidebar.warning(
+                    f"The export is {written:,} bytes, more than Streamlit can serve for download. "
+                    f"It was written to {export_path} and is deleted after {EXPORT_MAX_AGE // 60} minutes. "
+                    f"For large tables, run `{command}` instead."
+                )
+            elif st.get_option("server.enableStaticServing"):
+                # The browser downloads straight from the static file handler, which streams the file from disk
+                st.sidebar.markdown(
+                    f'<a href="app/static/exports/{os.path.basename(export_path)}" download="{file_name}">'
+                    f'📋 Download {export_format.upper()}</a> ({written:,} bytes)',
+                    unsafe_allow_html=True
+                )
+            else:
+                st.sidebar.info(f"Export written to {export_path} ({written:,} bytes)")
+
+    lead_id = st.sidebar.text_input("📜 Transcript for Lead ID")
+    if lead_id.strip().isdigit():
+        transcript = load_lead_transcript(int(lead_id))
+        if transcript:
+            with st.sidebar.expander(f"Transcript for lead {lead_id} ({len(transcript)} messages)", expanded=True):
+                for message in transcript:
+                    st.markdown(f"**{message['role'].title()}** · {message['timestamp']}\n\n{message['content']}")
+        else:
+            st.sidebar.info(f"No archived transcript for lead {lead_id}.")
+
     # Clear leads with confirmation
     if st.sidebar.checkbox("I understand this will permanently delete all leads"):
         if st.sidebar.button("🗑️ Clear All Leads"):
             try:
-                conn = sqlite3.connect(DB_FILE)
-                conn.execute("DELETE FROM leads")
-                conn.commit()
-                conn.close()
+                clear_all_leads()
                 st.sidebar.success("All leads cleared from database.")
                 log_system_message("DATABASE: All leads cleared")
             except Exception as e:
                 st.sidebar.error(f"Error clearing leads: {e}")
 
+def render_chat_message(message):
+    """Render one chat message, showing product images inline."""
+    with st.chat_message(message["role"]):
+        content = message["content"]
+
+        # Check if the message contains product recommendations with images
+        if "Image:" in content and message["role"] == "assistant":
+            # Split content into sections for each product
+            sections = content.split('**')
+            current_text = ""
+
+            for i, section in enumerate(sections):
+                if "Image:" in section:
+                    # Display accumulated text first
+                    if current_text:
+                        st.markdown(current_text)
+                        current_text = ""
+
+                    # Extract and display image
+                    lines = section.split('\n')
+                    for line in lines:
+                        if "Image:" in line:
+                            image_path = line.split("Image:")[1].strip()
+                            if os.path.exists(image_path):
+                                st.image(image_path, width=200)
+                            else:
+                                current_text += line + "\n"
+                        else:
+                            current_text += line + "\n"
+                else:
+                    current_text += "**" + section if i > 0 else section
+
+            # Display any remaining text
+            if current_text:
+                st.markdown(current_text)
+        else:
+            st.markdown(content)
+
 def main():
     """Main Streamlit application."""
     # Page configuration
@@ -816,7 +2454,15 @@ def main():
         layout="wide",
         initial_sidebar_state="expanded"
     )
-    
+    start_export_cleanup()
+
+    # Optional per-request profiling covers the whole script run, including message processing
+    request_id = uuid.uuid4().hex[:12]
+    with request_profiler(request_id):
+        render_app(request_id)
+
+def render_app(request_id):
+    """Render the page and handle a new chat message, if any."""
     # Header
     st.title("🌿 Herbal Products Page")
     st.markdown("""
@@ -830,6 +2476,8 @@ This chat will help us match your needs to our product or to the right specialis
     # Initialize session state
     if 'messages' not in st.session_state:
         st.session_state['messages'] = []
+    if 'session_id' not in st.session_state:
+        st.session_state['session_id'] = uuid.uuid4().hex
     if 'system_logs' not in st.session_state:
         st.session_state['system_logs'] = []
     
@@ -844,48 +2492,31 @@ This chat will help us match your needs to our product or to the right specialis
     col1, col2 = st.columns([2, 1])
     
     with col1:
+        # Older messages are only in the archive; load them on demand
+        live = st.session_state['messages']
+        first_live_seq = live[0].get("seq", 1) if live else st.session_state.get('transcript_seq', 0) + 1
+        if first_live_seq > 1:
+            # Only the pages asked for are decompressed and rendered on each rerun
+            archived = first_live_seq - 1
+            shown = min(st.session_state.get('archived_messages_shown', 0), archived)
+            load_col, hide_col = st.columns(2)
+            if shown < archived:
+                load_col.button(f"Load {min(ARCHIVE_PAGE_MESSAGES, archived - shown)} earlier messages "
+                                f"({archived - shown} not shown)",
+                                on_click=set_archived_messages_shown, args=(shown + ARCHIVE_PAGE_MESSAGES,))
+            if shown:
+                hide_col.button("Hide earlier messages", on_click=set_archived_messages_shown, args=(0,))
+                for message in load_transcript(st.session_state['session_id'], before_seq=first_live_seq, limit=shown):
+                    render_chat_message(message)
+
         # Display chat messages
-        for message in st.session_state['messages']:
-            with st.chat_message(message["role"]):
-                content = message["content"]
-                
-                # Check if the message contains product recommendations with images
-                if "Image:" in content and message["role"] == "assistant":
-                    # Split content into sections for each product
-                    sections = content.split('**')
-                    current_text = ""
-                    
-                    for i, section in enumerate(sections):
-                        if "Image:" in section:
-                            # Display accumulated text first
-                            if current_text:
-                                st.markdown(current_text)
-                                current_text = ""
-                            
-                            # Extract and display image
-                            lines = section.split('\n')
-                            for line in lines:
-                                if "Image:" in line:
-                                    image_path = line.split("Image:")[1].strip()
-                                    if os.path.exists(image_path):
-                                        st.image(image_path, width=200)
-                                    else:
-                                        current_text += line + "\n"
-                                else:
-                                    current_text += line + "\n"
-                        else:
-                            current_text += "**" + section if i > 0 else section
-                    
-                    # Display any remaining text
-                    if current_text:
-                        st.markdown(current_text)
-                else:
-                    st.markdown(content)
+        for message in live:
+            render_chat_message(message)
         
         # Chat input
         user_input = st.chat_input("Type your message here...")
         if user_input:
-            asyncio.run(process_user_message(user_input))
+            asyncio.run(process_user_message(user_input, request_id))
             st.rerun()
     
     with col2:
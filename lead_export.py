@@ -0,0 +1,183 @@
+# Streaming export of the leads table as NDJSON, CSV or Parquet.
+# Rows are read page by page with keyset pagination and written out chunk by chunk,
+# so peak memory depends on the page size, not on the size of the table.
+#
+# Command line:
+#   python lead_export.py --format csv --lead-type wholesale --since "2025-01-01" -o leads.csv
+#   python lead_export.py --format ndjson | gzip > leads.ndjson.gz
+
+import os
+import io
+import re
+import csv
+import json
+import sqlite3
+import sys
+import argparse
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet export is optional
+    pa = None
+    pq = None
+
+EXPORT_FORMATS = {
+    "ndjson": ("leads_export.ndjson", "application/x-ndjson"),
+    "csv": ("leads_export.csv", "text/csv"),
+    "parquet": ("leads_export.parquet", "application/vnd.apache.parquet"),
+}
+EXPORT_PAGE_SIZE = 1000
+DATE_ONLY = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+def available_export_formats():
+    """Formats usable in this environment (Parquet needs pyarrow)."""
+    return [fmt for fmt in EXPORT_FORMATS if fmt != "parquet" or pa is not None]
+
+def build_lead_filters(lead_type=None, priority=None, since=None, until=None):
+    """SQL conditions and parameters for the optional export filters."""
+    conditions, params = [], []
+    if lead_type:
+        conditions.append("lower(lead_type) = lower(?)")
+        params.append(lead_type)
+    if priority:
+        conditions.append("lower(priority) = lower(?)")
+        params.append(priority)
+    # Timestamps are stored as "YYYY-MM-DD HH:MM:SS", so string comparison orders them correctly
+    if since:
+        conditions.append("timestamp >= ?")
+        params.append(since)
+    if until:
+        conditions.append("timestamp <= ?")
+        # A bare date means "up to the end of that day", not midnight at its start
+        params.append(f"{until} 23:59:59" if DATE_ONLY.fullmatch(until) else until)
+    return conditions, params
+
+def get_lead_columns(conn):
+    return [row[1] for row in conn.execute("PRAGMA table_info(leads)")]
+
+def iter_lead_pages(db_file, page_size=EXPORT_PAGE_SIZE, **filters):
+    """Yield lists of lead rows (as tuples), resuming each page after the last id seen."""
+    conditions, params = build_lead_filters(**filters)
+    where = "".join(f" AND {condition}" for condition in conditions)
+    conn = sqlite3.connect(db_file)
+    try:
+        id_index = get_lead_columns(conn).index("id")
+        last_id = 0
+        while True:
+            rows = conn.execute(
+                f"SELECT * FROM leads WHERE id > ?{where} ORDER BY id LIMIT ?",
+                [last_id, *params, page_size],
+            ).fetchall()
+            if not rows:
+                break
+            yield rows
+            last_id = rows[-1][id_index]
+    finally:
+        conn.close()
+
+class _ChunkSink:
+    """Write-only file object that hands written bytes back in chunks."""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+def iter_export_chunks(db_file, fmt="ndjson", page_size=EXPORT_PAGE_SIZE, **filters):
+    """Yield the export as byte chunks, one chunk per page of leads."""
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format '{fmt}'. Choose from: {', '.join(EXPORT_FORMATS)}")
+    if fmt == "parquet" and pa is None:
+        raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow)")
+
+    conn = sqlite3.connect(db_file)
+    columns = get_lead_columns(conn)
+    conn.close()
+    pages = iter_lead_pages(db_file, page_size, **filters)
+
+    if fmt == "ndjson":
+        for rows in pages:
+            yield "".join(
+                json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n" for row in rows
+            ).encode("utf-8")
+
+    elif fmt == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        for rows in pages:
+            writer.writerows(rows)
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():  # header only, when nothing matched
+            yield buffer.getvalue().encode("utf-8")
+
+    else:
+        schema = pa.schema([(name, pa.int64() if name == "id" else pa.string()) for name in columns])
+        sink = _ChunkSink()
+        with pq.ParquetWriter(sink, schema, compression="zstd") as parquet_writer:
+            for rows in pages:
+                # One row group per page
+                parquet_writer.write_table(pa.Table.from_pylist([dict(zip(columns, row)) for row in rows], schema=schema))
+                yield sink.drain()
+        yield sink.drain()  # footer
+
+def export_leads(db_file, output, fmt="ndjson", page_size=EXPORT_PAGE_SIZE, **filters):
+    """Stream an export into a binary file object; returns the number of bytes written."""
+    written = 0
+    for chunk in iter_export_chunks(db_file, fmt, page_size, **filters):
+        output.write(chunk)
+        written += len(chunk)
+    return written
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stream the leads table to NDJSON, CSV or Parquet.")
+    parser.add_argument("--db", default=os.getenv("DB_FILE", "week3-db_leads.db"), help="SQLite database file")
+    parser.add_argument("--format", choices=list(EXPORT_FORMATS), default="ndjson")
+    parser.add_argument("-o", "--output", help="Output file (default: stdout)")
+    parser.add_argument("--lead-type", help="Only leads of this type, e.g. wholesale")
+    parser.add_argument("--priority", help="Only leads with this priority")
+    parser.add_argument("--since", help="Only leads stored at or after this timestamp (YYYY-MM-DD[ HH:MM:SS])")
+    parser.add_argument("--until", help="Only leads stored at or before this timestamp (a date alone includes that whole day)")
+    parser.add_argument("--page-size", type=int, default=EXPORT_PAGE_SIZE)
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.db):
+        parser.error(f"database file {args.db} not found")
+
+    filters = dict(lead_type=args.lead_type, priority=args.priority, since=args.since, until=args.until)
+    try:
+        if args.output:
+            with open(args.output, "wb") as f:
+                written = export_leads(args.db, f, args.format, args.page_size, **filters)
+            print(f"Exported {written} bytes to {args.output}", file=sys.stderr)
+        else:
+            export_leads(args.db, sys.stdout.buffer, args.format, args.page_size, **filters)
+    except (RuntimeError, sqlite3.Error) as e:
+        print(f"Export failed: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())